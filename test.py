@@ -1,103 +1,255 @@
+import functools
 import os
 import re
+import selectors
 import shutil
-import signal
 import socket
+import subprocess
 import tempfile
 import time
-from nose.tools import assert_not_in, assert_true  # type:ignore
-from types import FrameType
-from typing import Dict, IO, Optional
+from nose.tools import assert_equal, assert_not_in, assert_true  # type:ignore
+from typing import Dict, List, Optional, Union
 
 SERVER_PORT = 16667
+# The name the server uses for itself; getfqdn() may do a DNS lookup.
+SERVER_FQDN = socket.getfqdn()
+
+
+_escaped_fqdn = re.escape(SERVER_FQDN)
+_regexp_metachars = frozenset(".^$*+?{}[]|()\\")
+
+
+# Cached on the pattern exactly as written in the test, with the
+# local\S+ placeholder unsubstituted, so all work on a pattern (FQDN
+# substitution included) is done once per unique pattern. Callers should
+# pass their pattern unmodified rather than substituting anything first.
+@functools.lru_cache(maxsize=1024)
+def _compile_expect(regexp: str) -> "Union[str, re.Pattern[str]]":
+    # Patterns without metacharacters (apart from the server name
+    # placeholder) are returned as plain strings to compare against.
+    parts = regexp.split(r"local\S+")
+    if not any(_regexp_metachars.intersection(part) for part in parts):
+        return SERVER_FQDN.join(parts)
+    return re.compile(regexp.replace(r"local\S+", _escaped_fqdn))
+
+
+# Lines sent by the server after registration. The nickname is captured
+# so that the same compiled patterns can be used for all clients.
+_welcome_patterns = [
+    re.compile(rf":{_escaped_fqdn} {x}")
+    for x in [
+        r"001 (\S+) :.*",
+        r"002 (\S+) :.*",
+        r"003 (\S+) :.*",
+        r"004 (\S+) .*",
+        r"251 (\S+) :.*",
+        r"422 (\S+) :.*",
+    ]
+]
 
 
 class ServerFixture:
-    state_dir: Optional[str]
+    # One server is started per test class; subclasses may override these
+    # to configure it.
+    persistent = False
+    # Files to create in the state directory before the server starts.
+    state_files: Dict[str, bytes] = {}
+    channel_log = False
+    password: Optional[str] = None
+    # Content of the MOTD file, if any.
+    motd: Optional[str] = None
 
-    def setUp(
-        self, persistent: bool = False, password: Optional[str] = None
-    ) -> None:
-        if persistent:
-            self.state_dir = tempfile.mkdtemp()
+    state_dir: Optional[str]
+    channel_log_dir: Optional[str]
+    motd_file: Optional[str]
+    child: "subprocess.Popen[bytes]"
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        if cls.persistent:
+            cls.state_dir = tempfile.mkdtemp()
+            for name, content in cls.state_files.items():
+                with open(os.path.join(cls.state_dir, name), "wb") as f:
+                    f.write(content)
+        else:
+            cls.state_dir = None
+        if cls.channel_log:
+            cls.channel_log_dir = tempfile.mkdtemp()
         else:
-            self.state_dir = None
-        pid = os.fork()
-        if pid == 0:
-            # Child.
-            arguments = [
-                "miniircd",
-                # "--debug",
-                "--ports=%d" % SERVER_PORT,
-            ]
-            if persistent:
-                arguments.append(f"--state-dir={self.state_dir}")
-            if password:
-                arguments.append(f"--password={password}")
-            os.execv("./miniircd", arguments)
-        # Parent.
-        self.child_pid = pid
-        self.connections: Dict[str, IO[str]] = {}  # nick -> fp
+            cls.channel_log_dir = None
+        if cls.motd is not None:
+            fd, cls.motd_file = tempfile.mkstemp()
+            with os.fdopen(fd, "w") as f:
+                f.write(cls.motd)
+        else:
+            cls.motd_file = None
+        arguments = [
+            "./miniircd",
+            # "--debug",
+            "--ports=%d" % SERVER_PORT,
+        ]
+        if cls.persistent:
+            arguments.append(f"--state-dir={cls.state_dir}")
+        if cls.channel_log:
+            arguments.append(f"--channel-log-dir={cls.channel_log_dir}")
+        if cls.password:
+            arguments.append(f"--password={cls.password}")
+        if cls.motd_file:
+            arguments.append(f"--motd={cls.motd_file}")
+        cls.child = subprocess.Popen(arguments)
+        cls.wait_for_server()
+
+    @classmethod
+    def wait_for_server(cls) -> None:
+        # Retry with exponential backoff until the server is listening.
+        delay = 0.001
+        for _ in range(100):
+            if cls.child.poll() is not None:
+                break
+            with socket.socket() as s:
+                if s.connect_ex(("localhost", SERVER_PORT)) == 0:
+                    return
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+        cls.tearDownClass()
+        raise AssertionError("miniircd didn't start listening")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.child.terminate()
+        cls.child.wait()
+        for directory in [cls.state_dir, cls.channel_log_dir]:
+            if directory:
+                try:
+                    shutil.rmtree(directory)
+                except IOError:
+                    pass
+        if cls.motd_file:
+            os.remove(cls.motd_file)
+
+    def setUp(self) -> None:
+        self.connections: Dict[str, socket.socket] = {}
+        # Received data not yet consumed by expect().
+        self.buffers: Dict[str, bytearray] = {}
 
     def connect(self, nick: str, password: Optional[str] = None) -> None:
+        self.send_registration(nick, password)
+        self.expect_welcome(nick)
+
+    def send_registration(
+        self, nick: str, password: Optional[str] = None
+    ) -> None:
         assert_not_in(nick, self.connections)
-        s = socket.socket()
-        tries_left = 100
-        while tries_left > 0:
-            try:
-                s.connect(("localhost", SERVER_PORT))
-                break
-            except socket.error:
-                tries_left -= 1
-                time.sleep(0.01)
-        self.connections[nick] = s.makefile(mode="rw")
+        # The server is known to be listening since setUpClass.
+        # Give the server 1 second to respond to each read.
+        s = socket.create_connection(("localhost", SERVER_PORT), timeout=1)
+        self.connections[nick] = s
+        self.buffers[nick] = bytearray()
         if password is not None:
             self.send(nick, f"PASS {password}")
         self.send(nick, f"NICK {nick}")
         self.send(nick, f"USER {nick} * * {nick}")
-        self.expect(nick, rf":local\S+ 001 {nick} :.*")
-        self.expect(nick, rf":local\S+ 002 {nick} :.*")
-        self.expect(nick, rf":local\S+ 003 {nick} :.*")
-        self.expect(nick, rf":local\S+ 004 {nick} .*")
-        self.expect(nick, rf":local\S+ 251 {nick} :.*")
-        self.expect(nick, rf":local\S+ 422 {nick} :.*")
-
-    def shutDown(self) -> None:
-        os.kill(self.child_pid, signal.SIGTERM)
-        os.waitpid(self.child_pid, 0)
-        if self.state_dir:
+
+    def expect_welcome(self, nick: str) -> None:
+        for pattern in _welcome_patterns:
             try:
-                shutil.rmtree(self.state_dir)
-            except IOError:
-                pass
+                line = self.read_line(nick)
+            except socket.timeout:
+                raise AssertionError(
+                    "timeout while waiting for %r" % pattern.pattern
+                )
+            m = pattern.fullmatch(line)
+            assert_true(
+                m and m.group(1) == nick,
+                f"Regexp {pattern.pattern!r} didn't match {line!r}"
+                f" for {nick}",
+            )
 
     def tearDown(self) -> None:
-        self.shutDown()
-        for x in self.connections.values():
-            x.close()
+        # Quit all clients and wait until the server has closed the
+        # connections so that the next test starts with a clean server.
+        for s in self.connections.values():
+            try:
+                s.sendall(b"QUIT\r\n")
+                while s.recv(4096):
+                    pass
+            except OSError:
+                pass
+            s.close()
 
     def send(self, nick: str, message: str) -> None:
-        self.connections[nick].write(message + "\r\n")
-        self.connections[nick].flush()
+        self.connections[nick].sendall(f"{message}\r\n".encode())
+
+    def read_line(self, nick: str) -> str:
+        buf = self.buffers[nick]
+        while True:
+            end = buf.find(b"\n")
+            if end >= 0:
+                break
+            data = self.connections[nick].recv(4096)
+            if not data:
+                end = len(buf)
+                break
+            buf += data
+        line = buf[:end].rstrip(b"\r").decode()
+        del buf[: end + 1]
+        return line
 
     def expect(self, nick: str, regexp: str) -> None:
-        def timeout_handler(signum: int, frame: Optional[FrameType]) -> None:
+        try:
+            line = self.read_line(nick)
+        except socket.timeout:
             raise AssertionError("timeout while waiting for %r" % regexp)
+        expected = _compile_expect(regexp)
+        if isinstance(expected, str):
+            assert_true(
+                line == expected, f"Expected {expected!r}, got {line!r}"
+            )
+        else:
+            m = expected.fullmatch(line)
+            assert_true(
+                m, f"Regexp {expected.pattern!r} didn't match {line!r}"
+            )
 
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(1)  # Give the server 1 second to respond
-        line = self.connections[nick].readline().rstrip("\r\n")
-        signal.alarm(0)  # Cancel the alarm
-        regexp = f"^{regexp}$".replace(r"local\S+", socket.getfqdn())
-        m = re.match(regexp, line)
-        assert_true(m, f"Regexp {regexp!r} didn't match {line!r}")
+    def expect_any(self, expected: Dict[str, List[str]]) -> None:
+        # Like expect() for several connections at once. The lines for each
+        # nick must arrive in the given order, but connections are read in
+        # whatever order the server's output arrives.
+        remaining = {nick: list(regexps) for nick, regexps in expected.items()}
+        with selectors.DefaultSelector() as selector:
+            for nick in remaining:
+                selector.register(
+                    self.connections[nick], selectors.EVENT_READ, nick
+                )
+            while True:
+                # Check all complete lines received so far.
+                for nick, regexps in list(remaining.items()):
+                    while regexps and b"\n" in self.buffers[nick]:
+                        self.expect(nick, regexps.pop(0))
+                    if not regexps:
+                        del remaining[nick]
+                        selector.unregister(self.connections[nick])
+                if not remaining:
+                    return
+                events = selector.select(1)
+                if not events:
+                    raise AssertionError(
+                        "timeout while waiting for %r" % remaining
+                    )
+                for key, _ in events:
+                    nick = key.data
+                    data = self.connections[nick].recv(4096)
+                    if not data:
+                        raise AssertionError(
+                            f"{nick}: connection closed while waiting for"
+                            f" {remaining[nick]!r}"
+                        )
+                    self.buffers[nick] += data
 
 
 class TwoClientsTwoChannelsFixture(ServerFixture):
-    def setUp(
-        self, persistent: bool = False, password: Optional[str] = None
-    ) -> None:
-        super().setUp(persistent)
+    def setUp(self) -> None:
+        super().setUp()
         try:
             self.connect("apa")
             self.send("apa", "JOIN #fisk,#brugd")
@@ -124,7 +276,7 @@ class TwoClientsTwoChannelsFixture(ServerFixture):
             self.expect("apa", r":lemur!lemur@127.0.0.1 JOIN #fisk")
             self.expect("apa", r":lemur!lemur@127.0.0.1 JOIN #brugd")
         except Exception:
-            self.shutDown()
+            self.tearDown()
             raise
 
 
@@ -162,6 +314,13 @@ class TestBasicStuff(ServerFixture):
         self.send("apa", "JOIN")
         self.expect("apa", r":local\S+ 461 apa JOIN :Not enough parameters")
 
+    def test_join_bad_channelname(self) -> None:
+        self.connect("apa")
+        self.send("apa", "JOIN fisk")
+        self.expect("apa", r":local\S+ 403 apa fisk :No such channel")
+        self.send("apa", "JOIN #a:b")
+        self.expect("apa", r":local\S+ 403 apa #a:b :No such channel")
+
     def test_argumentless_list(self) -> None:
         self.connect("apa")
         self.send("apa", "LIST")
@@ -182,6 +341,13 @@ class TestBasicStuff(ServerFixture):
         self.send("apa", "NICK")
         self.expect("apa", r":local\S+ 431 :No nickname given")
 
+    def test_bad_nick(self) -> None:
+        self.connect("apa")
+        self.send("apa", "NICK 1abc")
+        self.expect("apa", r":local\S+ 432 apa 1abc :Erroneous Nickname")
+        self.send("apa", "NICK " + "a" * 52)
+        self.expect("apa", r":local\S+ 432 apa a{52} :Erroneous Nickname")
+
     def test_argumentless_notice(self) -> None:
         self.connect("apa")
         self.send("apa", "NOTICE")
@@ -248,36 +414,64 @@ class TestBasicStuff(ServerFixture):
         self.expect("apa", r":lemur!lemur@127.0.0.1 JOIN #fisk")
 
         self.send("lemur", "PART #fisk :boa")
-        self.expect("lemur", r":lemur!lemur@127.0.0.1 PART #fisk :boa")
-        self.expect("apa", r":lemur!lemur@127.0.0.1 PART #fisk :boa")
+        self.expect_any(
+            {
+                "lemur": [r":lemur!lemur@127.0.0.1 PART #fisk :boa"],
+                "apa": [r":lemur!lemur@127.0.0.1 PART #fisk :boa"],
+            }
+        )
+
+    def test_part_first_of_three_users(self) -> None:
+        for nick in ["apa", "bepa", "cepa"]:
+            self.connect(nick)
+            self.send(nick, "JOIN #fisk")
+            self.expect(nick, rf":{nick}!{nick}@127.0.0.1 JOIN #fisk")
+        self.send("apa", "PART #fisk")
+        self.expect("bepa", r":local\S+ 331 bepa #fisk :.*")
+        self.expect("bepa", r":local\S+ 353 bepa = #fisk :apa bepa")
+        self.expect("bepa", r":local\S+ 366 bepa #fisk :.*")
+        self.expect("bepa", r":cepa!cepa@127.0.0.1 JOIN #fisk")
+        self.expect("bepa", r":apa!apa@127.0.0.1 PART #fisk :apa")
+
+        self.send("cepa", "PRIVMSG #fisk :lax")
+        self.expect("bepa", r":cepa!cepa@127.0.0.1 PRIVMSG #fisk :lax")
+
+        self.send("bepa", "NAMES #fisk")
+        self.expect("bepa", r":local\S+ 353 bepa = #fisk :bepa cepa")
+        self.expect("bepa", r":local\S+ 366 bepa #fisk :.*")
 
     def test_join_and_name_many_users(self) -> None:
         base_nick = "A" * 49
         # :FQDN 353 nick = #fisk :
-        base_len = len(socket.getfqdn()) + 66
+        base_len = len(SERVER_FQDN) + 66
+
+        # Register all clients before waiting for any of them.
+        long_nicks = [f"{base_nick}{i}" for i in range(10)]
+        for long_nick in long_nicks:
+            self.send_registration(long_nick)
+        for long_nick in long_nicks:
+            self.expect_welcome(long_nick)
 
         one_line = (512 - base_len) // 50
-        nick_list_one = []
+        # Space-separated nicknames expected in each 353 line so far.
+        nicks_one = ""
         for i in range(one_line):
             long_nick = f"{base_nick}{i}"
-            nick_list_one.append(long_nick)
-            self.connect(long_nick)
+            nicks_one = f"{nicks_one} {long_nick}" if nicks_one else long_nick
             self.send(long_nick, "JOIN #fisk")
             self.expect(
                 long_nick, rf":{long_nick}!{long_nick}@127.0.0.1 JOIN #fisk"
             )
             self.expect(long_nick, rf":local\S+ 331 {long_nick} #fisk :.*")
-            nicks = " ".join(nick_list_one)
             self.expect(
-                long_nick, rf":local\S+ 353 {long_nick} = #fisk :{nicks}"
+                long_nick, rf":local\S+ 353 {long_nick} = #fisk :{nicks_one}"
             )
             self.expect(long_nick, rf":local\S+ 366 {long_nick} #fisk :.*")
 
-        nick_list_two = []
+        nicks_two = ""
         for i in range(10 - one_line):
             long_nick = f"{base_nick}{one_line + i}"
-            nick_list_two.append(long_nick)
-            self.connect(long_nick)
+            nicks_two = f"{nicks_two} {long_nick}" if nicks_two else long_nick
             self.send(long_nick, "JOIN #fisk")
             self.expect(
                 long_nick,
@@ -285,11 +479,9 @@ class TestBasicStuff(ServerFixture):
                 % {"nick": long_nick},
             )
             self.expect(long_nick, rf":local\S+ 331 {long_nick} #fisk :.*")
-            nicks_one = " ".join(nick_list_one)
             self.expect(
                 long_nick, rf":local\S+ 353 {long_nick} = #fisk :{nicks_one}"
             )
-            nicks_two = " ".join(nick_list_two)
             self.expect(
                 long_nick, rf":local\S+ 353 {long_nick} = #fisk :{nicks_two}"
             )
@@ -298,7 +490,7 @@ class TestBasicStuff(ServerFixture):
     def test_join_and_request_names(self) -> None:
         base_nick = "A" * 49
         # :FQDN 353 nick = #fisk :
-        base_len = len(socket.getfqdn()) + 66
+        base_len = len(SERVER_FQDN) + 66
 
         one_line = (512 - base_len) // 50
         nick_list_one = []
@@ -315,49 +507,35 @@ class TestBasicStuff(ServerFixture):
             self.connect(long_nick)
             self.send(long_nick, "JOIN #fisk")
 
-        self.expect(
+        # The expected #fisk name lines are the same for all requests.
+        names_one = r":local\S+ 353 %s = #fisk :%s" % (
             long_nick,
-            r":%(nick)s!%(nick)s@127.0.0.1 JOIN #fisk" % {"nick": long_nick},
+            " ".join(nick_list_one),
         )
-        self.expect(long_nick, r":local\S+ 331 %s #fisk :.*" % long_nick)
-        self.expect(
+        names_two = r":local\S+ 353 %s = #fisk :%s" % (
             long_nick,
-            r":local\S+ 353 %s = #fisk :%s"
-            % (long_nick, " ".join(nick_list_one)),
+            " ".join(nick_list_two),
         )
+
         self.expect(
             long_nick,
-            r":local\S+ 353 %s = #fisk :%s"
-            % (long_nick, " ".join(nick_list_two)),
+            r":%(nick)s!%(nick)s@127.0.0.1 JOIN #fisk" % {"nick": long_nick},
         )
+        self.expect(long_nick, r":local\S+ 331 %s #fisk :.*" % long_nick)
+        self.expect(long_nick, names_one)
+        self.expect(long_nick, names_two)
         self.expect(long_nick, r":local\S+ 366 %s #fisk :.*" % long_nick)
 
         # Request for one channel
         self.send(long_nick, "NAMES #fisk")
-        self.expect(
-            long_nick,
-            r":local\S+ 353 %s = #fisk :%s"
-            % (long_nick, " ".join(nick_list_one)),
-        )
-        self.expect(
-            long_nick,
-            r":local\S+ 353 %s = #fisk :%s"
-            % (long_nick, " ".join(nick_list_two)),
-        )
+        self.expect(long_nick, names_one)
+        self.expect(long_nick, names_two)
         self.expect(long_nick, r":local\S+ 366 %s #fisk :.*" % long_nick)
 
         # Request no channel
         self.send(long_nick, "NAMES")
-        self.expect(
-            long_nick,
-            r":local\S+ 353 %s = #fisk :%s"
-            % (long_nick, " ".join(nick_list_one)),
-        )
-        self.expect(
-            long_nick,
-            r":local\S+ 353 %s = #fisk :%s"
-            % (long_nick, " ".join(nick_list_two)),
-        )
+        self.expect(long_nick, names_one)
+        self.expect(long_nick, names_two)
         self.expect(long_nick, r":local\S+ 366 %s #fisk :.*" % long_nick)
 
         # Request for multiple channels
@@ -372,16 +550,8 @@ class TestBasicStuff(ServerFixture):
         )
         self.expect(long_nick, r":local\S+ 366 %s #test :.*" % long_nick)
         self.send(long_nick, "NAMES #fisk,#test")
-        self.expect(
-            long_nick,
-            r":local\S+ 353 %s = #fisk :%s"
-            % (long_nick, " ".join(nick_list_one)),
-        )
-        self.expect(
-            long_nick,
-            r":local\S+ 353 %s = #fisk :%s"
-            % (long_nick, " ".join(nick_list_two)),
-        )
+        self.expect(long_nick, names_one)
+        self.expect(long_nick, names_two)
         self.expect(long_nick, r":local\S+ 366 %s #fisk :.*" % long_nick)
         self.expect(
             long_nick, r":local\S+ 353 %s = #test :%s" % (long_nick, long_nick)
@@ -422,8 +592,12 @@ class TestTwoChannelsStuff(TwoClientsTwoChannelsFixture):
 
     def test_set_topic(self) -> None:
         self.send("apa", "TOPIC #fisk :sill")
-        self.expect("apa", r":apa!apa@127.0.0.1 TOPIC #fisk :sill")
-        self.expect("lemur", r":apa!apa@127.0.0.1 TOPIC #fisk :sill")
+        self.expect_any(
+            {
+                "apa": [r":apa!apa@127.0.0.1 TOPIC #fisk :sill"],
+                "lemur": [r":apa!apa@127.0.0.1 TOPIC #fisk :sill"],
+            }
+        )
 
         self.send("apa", "LIST")
         self.expect("apa", r":local\S+ 322 apa #brugd 2 :")
@@ -432,19 +606,31 @@ class TestTwoChannelsStuff(TwoClientsTwoChannelsFixture):
 
     def test_get_topic(self) -> None:
         self.send("apa", "TOPIC #fisk :sill")
-        self.expect("apa", r":apa!apa@127.0.0.1 TOPIC #fisk :sill")
-        self.expect("lemur", r":apa!apa@127.0.0.1 TOPIC #fisk :sill")
+        self.expect_any(
+            {
+                "apa": [r":apa!apa@127.0.0.1 TOPIC #fisk :sill"],
+                "lemur": [r":apa!apa@127.0.0.1 TOPIC #fisk :sill"],
+            }
+        )
         self.send("lemur", "TOPIC #fisk")
         self.expect("lemur", r":local\S+ 332 lemur #fisk :sill")
 
     def test_channel_key(self) -> None:
         self.send("apa", "MODE #fisk +k nors")
-        self.expect("apa", r":apa!apa@127.0.0.1 MODE #fisk \+k nors")
-        self.expect("lemur", r":apa!apa@127.0.0.1 MODE #fisk \+k nors")
+        self.expect_any(
+            {
+                "apa": [r":apa!apa@127.0.0.1 MODE #fisk \+k nors"],
+                "lemur": [r":apa!apa@127.0.0.1 MODE #fisk \+k nors"],
+            }
+        )
 
         self.send("apa", "PART #fisk")
-        self.expect("apa", r":apa!apa@127.0.0.1 PART #fisk :apa")
-        self.expect("lemur", r":apa!apa@127.0.0.1 PART #fisk :apa")
+        self.expect_any(
+            {
+                "apa": [r":apa!apa@127.0.0.1 PART #fisk :apa"],
+                "lemur": [r":apa!apa@127.0.0.1 PART #fisk :apa"],
+            }
+        )
 
         self.send("apa", "MODE #fisk -k")
         self.expect("apa", r":local\S+ 442 #fisk :.*")
@@ -456,15 +642,47 @@ class TestTwoChannelsStuff(TwoClientsTwoChannelsFixture):
         self.expect("apa", r":local\S+ 475 apa #fisk :.*")
 
         self.send("apa", "JOIN #fisk nors")
-        self.expect("apa", r":apa!apa@127.0.0.1 JOIN #fisk")
-        self.expect("apa", r":local\S+ 331 apa #fisk :.*")
-        self.expect("apa", r":local\S+ 353 apa = #fisk :apa lemur")
-        self.expect("apa", r":local\S+ 366 apa #fisk :.*")
-        self.expect("lemur", r":apa!apa@127.0.0.1 JOIN #fisk")
+        self.expect_any(
+            {
+                "apa": [
+                    r":apa!apa@127.0.0.1 JOIN #fisk",
+                    r":local\S+ 331 apa #fisk :.*",
+                    r":local\S+ 353 apa = #fisk :apa lemur",
+                    r":local\S+ 366 apa #fisk :.*",
+                ],
+                "lemur": [r":apa!apa@127.0.0.1 JOIN #fisk"],
+            }
+        )
 
         self.send("apa", "MODE #fisk")
         self.expect("apa", r":local\S+ 324 apa #fisk \+k nors")
 
+    def test_names_after_nick_change(self) -> None:
+        self.send("apa", "NICK bepa")
+        self.expect_any(
+            {
+                "apa": [r":apa!apa@127.0.0.1 NICK bepa"],
+                "lemur": [r":apa!apa@127.0.0.1 NICK bepa"],
+            }
+        )
+
+        self.send("lemur", "NAMES #fisk")
+        self.expect("lemur", r":local\S+ 353 lemur = #fisk :bepa lemur")
+        self.expect("lemur", r":local\S+ 366 lemur #fisk :.*")
+
+    def test_who(self) -> None:
+        self.send("apa", "WHO #fisk")
+        self.expect(
+            "apa",
+            r":local\S+ 352 apa #fisk apa 127.0.0.1 local\S+ apa H :0 apa",
+        )
+        self.expect(
+            "apa",
+            r":local\S+ 352 apa #fisk lemur 127.0.0.1 local\S+ lemur"
+            r" H :0 lemur",
+        )
+        self.expect("apa", r":local\S+ 315 apa #fisk :End of WHO list")
+
     def test_whois(self) -> None:
         self.send("apa", "WHOIS bepa")
         self.expect("apa", r":local\S+ 401 apa bepa :No such nick")
@@ -487,10 +705,7 @@ class TestTwoChannelsStuff(TwoClientsTwoChannelsFixture):
 
 
 class TestPersistentState(ServerFixture):
-    def setUp(
-        self, persistent: bool = True, password: Optional[str] = None
-    ) -> None:
-        super().setUp(persistent, password)
+    persistent = True
 
     def test_persistent_channel_state(self) -> None:
         self.connect("apa")
@@ -526,11 +741,99 @@ class TestPersistentState(ServerFixture):
         self.expect("apa", r":local\S+ 324 apa #fisk \+k skunk")
 
 
+class TestLegacyPersistentState(ServerFixture):
+    persistent = True
+    # State file format used by miniircd 2.3 and older.
+    state_files = {"#fisk": b"topic = b'm\\xc3\\xb6lusk'\nkey = b'skunk'\n"}
+
+    def test_legacy_channel_state(self) -> None:
+        self.connect("apa")
+
+        self.send("apa", "JOIN #fisk skunk")
+        self.expect("apa", r":apa!apa@127.0.0.1 JOIN #fisk")
+        self.expect("apa", r":local\S+ 332 apa #fisk :mölusk")
+        self.expect("apa", r":local\S+ 353 apa = #fisk :apa")
+        self.expect("apa", r":local\S+ 366 apa #fisk :.*")
+
+        self.send("apa", "MODE #fisk")
+        self.expect("apa", r":local\S+ 324 apa #fisk \+k skunk")
+
+
+class TestChannelLog(ServerFixture):
+    channel_log = True
+
+    def read_log(self, name: str) -> List[str]:
+        assert self.channel_log_dir
+        path = os.path.join(self.channel_log_dir, name)
+        with open(path) as f:
+            # Strip the timestamps.
+            return [line.split("] ", 1)[1] for line in f.read().splitlines()]
+
+    def sync(self, nick: str) -> None:
+        # Make sure that the server has handled everything sent so far.
+        self.send(nick, "PING :sync")
+        self.expect(nick, r":local\S+ PONG \S+ :sync")
+
+    def test_channel_log(self) -> None:
+        self.connect("apa")
+        self.send("apa", "JOIN #Fisk")
+        self.expect("apa", r":apa!apa@127.0.0.1 JOIN #Fisk")
+        self.expect("apa", r":local\S+ 331 apa #Fisk :.*")
+        self.expect("apa", r":local\S+ 353 apa = #Fisk :apa")
+        self.expect("apa", r":local\S+ 366 apa #Fisk :.*")
+        self.send("apa", "PRIVMSG #Fisk :one")
+        self.sync("apa")
+        assert_equal(
+            self.read_log("#fisk.log"), ["* apa joined", "<apa> one"]
+        )
+
+        # Rotate the log; the server checks for that at most once a second.
+        assert self.channel_log_dir
+        os.rename(
+            os.path.join(self.channel_log_dir, "#fisk.log"),
+            os.path.join(self.channel_log_dir, "#fisk.log.1"),
+        )
+        time.sleep(1.1)
+        self.send("apa", "PRIVMSG #Fisk :two")
+        self.sync("apa")
+        assert_equal(
+            self.read_log("#fisk.log.1"), ["* apa joined", "<apa> one"]
+        )
+        assert_equal(self.read_log("#fisk.log"), ["<apa> two"])
+
+
+class TestMotd(ServerFixture):
+    motd = "Welcome\nto the  \nserver\n"
+
+    def test_motd(self) -> None:
+        self.send_registration("apa")
+        self.expect("apa", r":local\S+ 001 apa :.*")
+        self.expect("apa", r":local\S+ 002 apa :.*")
+        self.expect("apa", r":local\S+ 003 apa :.*")
+        self.expect("apa", r":local\S+ 004 apa .*")
+        self.expect("apa", r":local\S+ 251 apa :.*")
+        self.expect(
+            "apa", r":local\S+ 375 apa :- local\S+ Message of the day -"
+        )
+        self.expect("apa", r":local\S+ 372 apa :- Welcome")
+        self.expect("apa", r":local\S+ 372 apa :- to the")
+        self.expect("apa", r":local\S+ 372 apa :- server")
+        self.expect("apa", r":local\S+ 376 apa :End of /MOTD command")
+
+        # An updated MOTD file is read again.
+        assert self.motd_file
+        with open(self.motd_file, "w") as f:
+            f.write("Goodbye\n")
+        self.send("apa", "MOTD")
+        self.expect(
+            "apa", r":local\S+ 375 apa :- local\S+ Message of the day -"
+        )
+        self.expect("apa", r":local\S+ 372 apa :- Goodbye")
+        self.expect("apa", r":local\S+ 376 apa :End of /MOTD command")
+
+
 class TestPassword(ServerFixture):
-    def setUp(
-        self, persistent: bool = False, password: Optional[str] = None
-    ) -> None:
-        super().setUp(persistent, password="krokodil")
+    password = "krokodil"
 
     def test_no_password(self) -> None:
         try: